@@ -0,0 +1,145 @@
+"""代码块解析微基准。
+
+生成包含大量围栏代码块和说明文字的多 MB 消息，测量 extract_code_blocks 的吞吐量；
+同时校验解析器的边界情况，以及 TaskRecorder.code_blocks 对同一消息只解析一次。
+
+用法:
+  python benchmark_code_blocks.py --size-mb 4 --repeat 5
+"""
+
+import argparse
+import sys
+import time
+from typing import List, Tuple
+
+from code_blocks import CodeBlock, extract_code_blocks
+
+_SNIPPET = (
+    "def handler(event, context):\n"
+    "    items = [x for x in event.get('items', []) if x]\n"
+    "    return {'count': len(items)}\n"
+)
+
+
+def build_message(size_bytes: int) -> str:
+    """构造约 size_bytes 大小的消息：说明文字与 python / json / 无标签代码块交替出现。"""
+    parts: List[str] = []
+    total = 0
+    languages = ["python", "json", ""]
+    i = 0
+    while total < size_bytes:
+        chunk = (
+            f"说明 {i}：以下代码块演示第 {i} 个处理函数。\n\n"
+            f"```{languages[i % len(languages)]}\n"
+            + _SNIPPET * 20
+            + "```\n\n"
+        )
+        parts.append(chunk)
+        total += len(chunk)
+        i += 1
+    parts.append("TERMINATE\n")
+    return "".join(parts)
+
+
+# (名称, 输入, 期望的 (语言, 代码, 是否闭合) 列表)
+EDGE_CASES: List[Tuple[str, str, List[Tuple[str, str, bool]]]] = [
+    ("未闭合围栏", "说明\n```python\nprint(1)\n", [("python", "print(1)", False)]),
+    (
+        "更长的围栏包裹 ```",
+        "````markdown\n```python\nx = 1\n```\n````\n",
+        [("markdown", "```python\nx = 1\n```", True)],
+    ),
+    ("波浪号围栏", "~~~js\nlet a = 1;\n~~~\n", [("js", "let a = 1;", True)]),
+    ("波浪号围栏内的 ```", "~~~\n```\nx\n~~~\n", [("", "```\nx", True)]),
+    (
+        "info string 含反引号不是围栏",
+        "```py`x\n```python\nprint(1)\n```\n",
+        [("python", "print(1)", True)],
+    ),
+    ("CRLF 换行", "```python\r\nx = 1\r\ny = 2\r\n```\r\n", [("python", "x = 1\r\ny = 2", True)]),
+    ("CRLF 未闭合", "```python\r\nx = 1\r\n", [("python", "x = 1", False)]),
+    (
+        "列表项下缩进的围栏",
+        "1. 实现:\n   ```python\n   def f():\n       return 1\n  x = 2\n   ```\n",
+        [("python", "def f():\n    return 1\nx = 2", True)],
+    ),
+]
+
+
+def check_edge_cases() -> List[str]:
+    """返回与期望不一致的边界用例说明。"""
+    errors: List[str] = []
+    for name, text, expected in EDGE_CASES:
+        actual = [(b.language, b.code, b.closed) for b in extract_code_blocks(text)]
+        if actual != expected:
+            errors.append(f"{name}: 期望 {expected!r}，实际 {actual!r}")
+    return errors
+
+
+def check_recorder_cache(text: str) -> List[str]:
+    """校验 TaskRecorder.code_blocks：首次访问未命中并解析，第二次访问命中缓存且不再解析。"""
+    # 延迟导入：只有这项校验需要 AutoGen 依赖
+    import metrics
+    from improved_three_agent_workflow import TaskRecorder
+
+    recorder = TaskRecorder("benchmark", 0)
+    recorder.add_message("integrator", text)
+    message = recorder.messages[0]
+
+    def counts() -> Tuple[float, float]:
+        return (
+            metrics.CACHE_REQUESTS.value(cache="code_blocks", result="hit"),
+            metrics.CACHE_REQUESTS.value(cache="code_blocks", result="miss"),
+        )
+
+    errors: List[str] = []
+    hits, misses = counts()
+    t0 = time.perf_counter()
+    first = recorder.code_blocks(message)
+    first_time = time.perf_counter() - t0
+    if counts() != (hits, misses + 1):
+        errors.append("首次访问应记为一次未命中")
+
+    t0 = time.perf_counter()
+    second = recorder.code_blocks(message)
+    second_time = time.perf_counter() - t0
+    if counts() != (hits + 1, misses + 1):
+        errors.append("第二次访问应记为一次命中")
+    if second is not first:
+        errors.append("第二次访问重新解析了消息")
+    print(f"TaskRecorder 首次访问: {first_time * 1000:.2f} ms, 缓存命中: {second_time * 1000:.4f} ms")
+    return errors
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description="extract_code_blocks 微基准")
+    parser.add_argument("--size-mb", type=float, default=4.0, help="单条消息大小（MB），默认 4")
+    parser.add_argument("--repeat", type=int, default=5, help="重复次数，取最优值，默认 5")
+    args = parser.parse_args(argv)
+
+    text = build_message(int(args.size_mb * 1024 * 1024))
+    timings: List[float] = []
+    blocks = []
+    for _ in range(max(1, args.repeat)):
+        t0 = time.perf_counter()
+        blocks = extract_code_blocks(text)
+        timings.append(time.perf_counter() - t0)
+
+    best = min(timings)
+    mb = len(text.encode("utf-8")) / (1024 * 1024)
+    print(f"消息大小: {mb:.2f} MB, 代码块数: {len(blocks)}")
+    print(f"最优耗时: {best * 1000:.2f} ms, 吞吐量: {mb / best:.1f} MB/s")
+
+    # 校验解析结果：每个代码块的正文都应与片段一致
+    expected = _SNIPPET * 20
+    bad: List[CodeBlock] = [b for b in blocks if b.code + "\n" != expected]
+    errors = [f"{len(bad)} 个代码块解析结果不正确"] if bad else []
+    errors.extend(check_edge_cases())
+    errors.extend(check_recorder_cache(text))
+    for error in errors:
+        print(f"[ERROR] {error}", file=sys.stderr)
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
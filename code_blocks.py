@@ -0,0 +1,175 @@
+"""Markdown 代码块单遍解析工具。
+
+对一条消息只做一次正则扫描，提取所有围栏代码块（``` 或 ~~~）及其语言标签与偏移量，
+供任务记录渲染和最终代码导出复用。本模块不依赖 AutoGen，可被下游工具直接导入。
+"""
+
+import os
+import re
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+# 围栏行：行首最多 3 个空格缩进，随后 3 个以上反引号或波浪号，其余为 info string
+_FENCE_RE = re.compile(r"^ {0,3}(`{3,}|~{3,})([^\n]*)$", re.MULTILINE)
+
+# 语言标签 -> 导出文件扩展名
+LANGUAGE_EXTENSIONS: Dict[str, str] = {
+    "python": "py",
+    "py": "py",
+    "python3": "py",
+    "javascript": "js",
+    "js": "js",
+    "typescript": "ts",
+    "ts": "ts",
+    "java": "java",
+    "go": "go",
+    "rust": "rs",
+    "c": "c",
+    "cpp": "cpp",
+    "c++": "cpp",
+    "csharp": "cs",
+    "cs": "cs",
+    "bash": "sh",
+    "sh": "sh",
+    "shell": "sh",
+    "sql": "sql",
+    "json": "json",
+    "yaml": "yaml",
+    "yml": "yaml",
+    "toml": "toml",
+    "html": "html",
+    "css": "css",
+    "markdown": "md",
+    "md": "md",
+}
+
+
+@dataclass(frozen=True)
+class CodeBlock:
+    """一个围栏代码块。
+
+    start/end 是整个代码块（含围栏行）在原文中的偏移，code_start/code_end 是代码正文的偏移。
+    开启围栏有缩进时，code 的每一行会去掉至多同样多的前导空格，因此可能比原文切片短。
+    """
+
+    language: str
+    code: str
+    start: int
+    end: int
+    code_start: int
+    code_end: int
+    closed: bool = True
+
+    @property
+    def extension(self) -> str:
+        if self.language in LANGUAGE_EXTENSIONS:
+            return LANGUAGE_EXTENSIONS[self.language]
+        # 未知语言仅在标签为纯字母数字时直接用作扩展名，防止路径注入
+        return self.language if self.language.isalnum() else "txt"
+
+
+def extract_code_blocks(text: str) -> List[CodeBlock]:
+    """单遍提取 text 中的所有围栏代码块。
+
+    规则遵循 CommonMark 的主要约定：闭合围栏须使用相同字符、长度不小于开启围栏且不带 info string；
+    未闭合的代码块延伸到文本末尾。
+    """
+    blocks: List[CodeBlock] = []
+    opening: Optional[Tuple[re.Match, str]] = None
+
+    for match in _FENCE_RE.finditer(text):
+        fence, info = match.group(1), match.group(2)
+        if opening is None:
+            # 反引号围栏的 info string 中不允许出现反引号
+            if fence[0] == "`" and "`" in info:
+                continue
+            opening = (match, fence)
+            continue
+
+        open_match, open_fence = opening
+        if fence[0] != open_fence[0] or len(fence) < len(open_fence) or info.strip():
+            continue
+
+        code_start = min(open_match.end() + 1, match.start())
+        code_end = max(code_start, match.start() - 1)
+        # CRLF 文本中闭合围栏前的换行是 "\r\n"，\r 不属于代码正文
+        if code_end > code_start and text[code_end - 1] == "\r":
+            code_end -= 1
+        blocks.append(CodeBlock(
+            language=_language_of(open_match.group(2)),
+            code=_dedent(text[code_start:code_end], _indent_of(open_match)),
+            start=open_match.start(),
+            end=match.end(),
+            code_start=code_start,
+            code_end=code_end,
+        ))
+        opening = None
+
+    if opening is not None:
+        open_match = opening[0]
+        code_start = min(open_match.end() + 1, len(text))
+        blocks.append(CodeBlock(
+            language=_language_of(open_match.group(2)),
+            code=_dedent(text[code_start:].rstrip("\r\n"), _indent_of(open_match)),
+            start=open_match.start(),
+            end=len(text),
+            code_start=code_start,
+            code_end=len(text),
+            closed=False,
+        ))
+    return blocks
+
+
+def _indent_of(fence_match: re.Match) -> int:
+    line = fence_match.group(0)
+    return len(line) - len(line.lstrip(" "))
+
+
+def _dedent(code: str, indent: int) -> str:
+    """按 CommonMark 规则，从每行去掉至多 indent 个前导空格（开启围栏的缩进）。"""
+    if not indent:
+        return code
+    return "".join(
+        line[min(indent, len(line) - len(line.lstrip(" "))):] for line in code.splitlines(keepends=True)
+    )
+
+
+def _language_of(info: str) -> str:
+    words = info.split(None, 1)
+    return words[0].lower() if words else ""
+
+
+def split_prose(text: str, blocks: List[CodeBlock]) -> List[str]:
+    """返回代码块之间的非代码文本片段（共 len(blocks) + 1 段）。"""
+    pieces: List[str] = []
+    cursor = 0
+    for block in blocks:
+        pieces.append(text[cursor:block.start])
+        cursor = block.end
+    pieces.append(text[cursor:])
+    return pieces
+
+
+def render_fenced(code: str, language: str = "") -> str:
+    """用足够长的反引号围栏包裹 code，避免正文中的 ``` 提前闭合代码块。"""
+    longest = max((len(m.group(0)) for m in re.finditer(r"`{3,}", code)), default=0)
+    fence = "`" * max(3, longest + 1)
+    return f"{fence}{language}\n{code}\n{fence}"
+
+
+def export_code_blocks(blocks: List[CodeBlock], directory: str, basename: str = "final") -> List[str]:
+    """将代码块写入 directory，返回写入的文件路径列表。
+
+    第一个代码块写入 ``{basename}.{ext}``，其余依次写入 ``{basename}_2.{ext}``、``{basename}_3.{ext}`` ...
+    """
+    if not blocks:
+        return []
+    os.makedirs(directory, exist_ok=True)
+    paths: List[str] = []
+    for i, block in enumerate(blocks, start=1):
+        suffix = "" if i == 1 else f"_{i}"
+        path = os.path.join(directory, f"{basename}{suffix}.{block.extension}")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(block.code.rstrip("\n") + "\n")
+        paths.append(path)
+    return paths
@@ -1,12 +1,14 @@
 import asyncio
+import dataclasses
 import os
 import sys
 import argparse
 import json
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Callable, Union
 import datetime
 import re
 import glob
+import time
 
 # 尝试加载.env文件中的环境变量
 from dotenv import load_dotenv
@@ -27,15 +29,38 @@ from autogen_agentchat.messages import TextMessage, BaseAgentEvent, BaseChatMess
 from autogen_agentchat.base import TaskResult
 from autogen_ext.models.openai import OpenAIChatCompletionClient
 from autogen_core import CancellationToken
+from autogen_core.models import ChatCompletionClient
+
+from code_blocks import CodeBlock, export_code_blocks, extract_code_blocks, render_fenced, split_prose
+from model_clients import (
+    DEFAULT_PREFIX_CACHE,
+    PrefixCache,
+    PrefixCachingChatCompletionClient,
+    RetryPolicy,
+    RetryingChatCompletionClient,
+    is_retryable,
+)
+import metrics
+
+# 命令行模式下持久化提示词前缀索引的默认文件
+PREFIX_CACHE_FILE = os.path.join("task_md", "prefix_cache.bin")
 
 
-def build_model_client(api_key: Optional[str] = None, base_url: Optional[str] = None) -> OpenAIChatCompletionClient:
+def build_model_client(
+    api_key: Optional[str] = None,
+    base_url: Optional[str] = None,
+    retry_policy: Optional[RetryPolicy] = None,
+    prefix_cache: Optional[PrefixCache] = None,
+) -> PrefixCachingChatCompletionClient:
     """Create an OpenAI-compatible chat completion client targeting Mistral.
 
     Priority of configuration:
     - MISTRAL_API_KEY env var (required unless api_key is provided explicitly)
     - MISTRAL_BASE_URL env var or default "https://api.mistral.ai/v1"
     Model is fixed to "mistral-medium-latest" per requirements.
+    The client is wrapped so that transient errors are retried per call according to retry_policy,
+    and every logical call is looked up in prefix_cache (default: the process-wide DEFAULT_PREFIX_CACHE)
+    to measure how much of the prompt is a reusable prefix.
     """
     key = api_key or os.environ.get("MISTRAL_API_KEY")
     if not key:
@@ -45,7 +70,7 @@ def build_model_client(api_key: Optional[str] = None, base_url: Optional[str] =
     url = base_url or os.environ.get("MISTRAL_BASE_URL", "https://api.mistral.ai/v1")
 
     # Use OpenAI-compatible client with base_url override to call Mistral's Chat Completions API
-    return OpenAIChatCompletionClient(
+    client = OpenAIChatCompletionClient(
         model="mistral-medium-latest",
         api_key=key,
         base_url=url,
@@ -58,20 +83,52 @@ def build_model_client(api_key: Optional[str] = None, base_url: Optional[str] =
         },
         # You may tune these defaults if needed
         temperature=0.2,
+        # Retries are handled by RetryingChatCompletionClient so that backoff is governed by one policy
+        max_retries=0,
+    )
+    return PrefixCachingChatCompletionClient(
+        RetryingChatCompletionClient(client, retry_policy or RetryPolicy()),
+        prefix_cache,
     )
 
 
-def build_agents(model_client: OpenAIChatCompletionClient):
+# ---- Agent Prompts ----
+# 角色描述同时用于 AssistantAgent.description（SelectorGroupChat 的 {roles}）和团队公共前言。
+AGENT_DESCRIPTIONS: Dict[str, str] = {
+    "coder": (
+        "初始代码编写专家。负责根据用户需求编写第一版完整可运行的代码实现。"
+        "擅长选择简单稳健的技术方案，处理需求歧义，快速产出可工作的代码原型。"
+        "当收到新的开发任务时，应该首先由该代理开始工作。"
+    ),
+    "reviewer": (
+        "代码审查与质量保证专家。负责对 coder 生成的代码进行深度审查，"
+        "从性能、安全性、可读性、健壮性、边界条件、测试覆盖等多个维度提供改进建议。"
+        "仅在 coder 完成初始代码后才开始工作。"
+    ),
+    "integrator": (
+        "代码集成与优化专家。负责整合 coder 的初始代码和 reviewer 的审查建议，"
+        "产出经过优化和完善的最终生产级代码。确保所有建议被合理采纳，代码质量达到最高标准。"
+        "仅在 reviewer 完成审查后才开始工作，完成后输出 TERMINATE 结束流程。"
+    ),
+}
+
+# 所有代理系统消息共用的稳定前缀。其中只包含常量文本，保证跨运行、跨代理逐字节一致，
+# 便于推理服务端和本地 PrefixCache 复用前缀；任务相关的可变内容只出现在后续的用户消息中。
+TEAM_PREAMBLE = (
+    "你是 coder → reviewer → integrator 三代理代码生成团队中的一员。\n"
+    "团队角色:\n"
+    + "".join(f"- {name}: {description}\n" for name, description in AGENT_DESCRIPTIONS.items())
+    + "\n"
+)
+
+
+def build_agents(model_client: ChatCompletionClient):
     """Define the three-role workflow: coder -> reviewer -> integrator."""
     coder = AssistantAgent(
         name="coder",
         model_client=model_client,
-        description=(
-            "初始代码编写专家。负责根据用户需求编写第一版完整可运行的代码实现。"
-            "擅长选择简单稳健的技术方案，处理需求歧义，快速产出可工作的代码原型。"
-            "当收到新的开发任务时，应该首先由该代理开始工作。"
-        ),
-        system_message=(
+        description=AGENT_DESCRIPTIONS["coder"],
+        system_message=TEAM_PREAMBLE + (
             "你是资深开发工程师(coder)。\n"
             "任务: 基于用户的开发需求，编写满足需求的完整、可运行代码。\n"
             "要求:\n"
@@ -85,12 +142,8 @@ def build_agents(model_client: OpenAIChatCompletionClient):
     reviewer = AssistantAgent(
         name="reviewer",
         model_client=model_client,
-        description=(
-            "代码审查与质量保证专家。负责对 coder 生成的代码进行深度审查，"
-            "从性能、安全性、可读性、健壮性、边界条件、测试覆盖等多个维度提供改进建议。"
-            "仅在 coder 完成初始代码后才开始工作。"
-        ),
-        system_message=(
+        description=AGENT_DESCRIPTIONS["reviewer"],
+        system_message=TEAM_PREAMBLE + (
             "你是代码审查专家(reviewer)。\n"
             "任务: 针对 coder 提供的代码，提出具体、可操作的改进建议(性能、可读性、健壮性、安全性、边界条件、测试等)。\n"
             "要求:\n"
@@ -104,12 +157,8 @@ def build_agents(model_client: OpenAIChatCompletionClient):
     integrator = AssistantAgent(
         name="integrator",
         model_client=model_client,
-        description=(
-            "代码集成与优化专家。负责整合 coder 的初始代码和 reviewer 的审查建议，"
-            "产出经过优化和完善的最终生产级代码。确保所有建议被合理采纳，代码质量达到最高标准。"
-            "仅在 reviewer 完成审查后才开始工作，完成后输出 TERMINATE 结束流程。"
-        ),
-        system_message=(
+        description=AGENT_DESCRIPTIONS["integrator"],
+        system_message=TEAM_PREAMBLE + (
             "你是集成与优化专家(integrator)。\n"
             "任务: 基于 coder 的初版代码和 reviewer 的改进建议，输出优化与完善后的最终代码。\n"
             "要求:\n"
@@ -124,6 +173,41 @@ def build_agents(model_client: OpenAIChatCompletionClient):
     return coder, reviewer, integrator
 
 
+# 多文件模式下清单允许的最大文件数
+MAX_MANIFEST_FILES = 12
+
+
+def build_planner(model_client: ChatCompletionClient) -> AssistantAgent:
+    """多文件模式下 coder 的规划阶段：只输出文件清单，不写代码。"""
+    return AssistantAgent(
+        name="planner",
+        model_client=model_client,
+        description="项目规划专家。负责把开发需求拆分为多个源文件，并输出文件清单。",
+        system_message=TEAM_PREAMBLE + (
+            "你是资深开发工程师(coder)，当前处于规划阶段。\n"
+            "任务: 基于用户的开发需求，设计项目的文件结构，输出文件清单。\n"
+            "要求:\n"
+            "- 仅输出一个 json 代码块，格式为 "
+            '{"files": [{"path": "相对路径", "purpose": "该文件的职责与对外接口"}]}。\n'
+            "- path 必须是相对路径，不得包含 .. 或以 / 开头。\n"
+            "- purpose 需写明该文件提供的函数/类及其签名，便于各文件独立实现后能相互配合。\n"
+            f"- 文件数量不超过 {MAX_MANIFEST_FILES} 个，尽量使用标准库。\n"
+            "- 在代码块外不要输出任何内容。"
+        ),
+    )
+
+
+def build_termination(timeout_seconds: int):
+    """改进的终止条件 - 组合多种条件提供全面保护"""
+    return (
+        # 只认 integrator 的 TERMINATE：公共前言里的角色描述提到了它，其他代理复述时不应结束流程
+        TextMentionTermination("TERMINATE", sources=["integrator"]) |
+        MaxMessageTermination(20) |                     # 最多20条消息防止无限循环
+        TimeoutTermination(timeout_seconds) |           # 超时保护
+        SourceMatchTermination(["integrator"])          # integrator 完成后可结束
+    )
+
+
 # ---- Intelligent Selector Functions for SelectorGroupChat ----
 def create_selector_func():
     """创建智能选择器函数，根据消息内容选择下一个发言者"""
@@ -186,17 +270,16 @@ def create_candidate_func():
 
 
 def create_selector_prompt() -> str:
-    """创建自定义选择器提示词"""
+    """创建自定义选择器提示词
+
+    稳定内容（角色说明、选择原则）在前，每次选择都会变化的对话历史和候选列表在后，
+    使提示词前缀在多次选择和多次运行之间保持一致，便于前缀缓存复用。
+    """
     return """根据当前对话上下文选择最合适的代理来执行下一步任务。
 
 代理角色说明：
 {roles}
 
-当前对话历史：
-{history}
-
-请从 {participants} 中选择一个代理。
-
 选择原则：
 1. 如果是新任务或用户刚输入需求，选择 coder 开始编码
 2. 如果 coder 刚完成代码，选择 reviewer 进行审查
@@ -204,6 +287,11 @@ def create_selector_prompt() -> str:
 4. 如果 integrator 已完成，任务应该结束
 
 只需返回代理名称，不要额外解释。
+
+当前对话历史：
+{history}
+
+请从 {participants} 中选择一个代理。
 """
 
 
@@ -211,59 +299,14 @@ def create_selector_prompt() -> str:
 ROLE_ORDER = ["user", "coder", "reviewer", "integrator"]
 
 
-def _guess_is_code(text: str) -> bool:
-    if "\n" not in text and len(text) > 400:
-        return True
-    hints = ["def ", "class ", "import ", "from ", "#!/usr/bin", "console.log", "public "]
-    return any(h in text for h in hints)
-
-
-def _strip_fenced_block_if_list(text: str) -> str:
-    """If text is a fenced block whose body is mostly list items, strip the fences."""
-    stripped = text.strip()
-    if stripped.startswith("```") and stripped.endswith("```"):
-        body = stripped.split("\n", 1)[1]
-        if body.endswith("```"):
-            body = body[:-3]
-        lines = [l.strip() for l in body.strip().splitlines()]
-        if lines and sum(1 for l in lines if l.startswith("-") or l[:2] in {"- ", "* ", "+ "}) >= max(1, int(0.6 * len(
-                lines))):
-            return "\n".join(lines)
-    return text
-
-
-def _clean_code_fences(text: str) -> str:
-    """Clean up code fences to avoid duplication and ensure proper formatting."""
-    stripped = text.strip()
-    
-    # If content doesn't start with code fences, return as is
-    if not stripped.startswith("```"):
-        return stripped
-    
-    # Extract the content between the first and last code fences
-    lines = stripped.split("\n")
-    
-    # Find the first line that starts with ```
-    start_idx = 0
-    for i, line in enumerate(lines):
-        if line.startswith("```"):
-            start_idx = i
-            break
-    
-    # Find the last line that starts with ```
-    end_idx = len(lines) - 1
-    for i in range(len(lines) - 1, -1, -1):
-        if lines[i].startswith("```"):
-            end_idx = i
-            break
-    
-    # If we found proper code fences, extract the content between them
-    if start_idx < end_idx:
-        content_lines = lines[start_idx + 1:end_idx]
-        return "\n".join(content_lines)
-    
-    # If something went wrong, return the original text
-    return stripped
+def _strip_fenced_block_if_list(content: str, blocks: List[CodeBlock]) -> str:
+    """If content is a single fenced block whose body is mostly list items, strip the fences."""
+    if len(blocks) != 1 or any(p.strip() for p in split_prose(content, blocks)):
+        return content
+    lines = [l.strip() for l in blocks[0].code.strip().splitlines()]
+    if lines and sum(1 for l in lines if l[:2] in {"- ", "* ", "+ "} or l.startswith("-")) >= max(1, int(0.6 * len(lines))):
+        return "\n".join(lines)
+    return content
 
 
 class TaskRecorder:
@@ -274,52 +317,75 @@ class TaskRecorder:
         self.end_time: Optional[datetime.datetime] = None
         self.messages: List[Dict[str, Any]] = []
         self.terminated_by: Optional[str] = None
+        # 工作流校验时期望的角色顺序
+        self.role_order: List[str] = list(ROLE_ORDER)
+        # 提示词前缀缓存统计，见 PrefixCachingChatCompletionClient.stats
+        self.prefix_cache_stats: Optional[Dict[str, float]] = None
 
     def add_message(self, source: str, content: str) -> None:
         role = (source or "unknown").lower()
-        self.messages.append({"role": role, "content": content})
-        if "TERMINATE" in content:
+        # code_blocks 在首次访问时解析并缓存，见 code_blocks()
+        self.messages.append({"role": role, "content": content, "code_blocks": None})
+        if role == "integrator" and "TERMINATE" in content:
             self.terminated_by = "TERMINATE"
 
     def finalize(self) -> None:
         self.end_time = datetime.datetime.now()
 
+    def code_blocks(self, message: Dict[str, Any]) -> List[CodeBlock]:
+        """返回消息中的代码块；每条消息只解析一次，结果缓存在记录上。"""
+        hit = message["code_blocks"] is not None
+        metrics.observe_cache("code_blocks", hit)
+        if not hit:
+            message["code_blocks"] = extract_code_blocks(message["content"])
+        return message["code_blocks"]
+
+    def final_code_blocks(self) -> List[CodeBlock]:
+        """返回最后一条包含代码块的 integrator 消息中的代码块。"""
+        for m in reversed(self.messages):
+            if m["role"] == "integrator":
+                blocks = self.code_blocks(m)
+                if blocks:
+                    return blocks
+        return []
+
+    def export_final_code(self, directory: str) -> List[str]:
+        """将 integrator 的最终代码导出为真实文件（如 task_md/N/final.py）。"""
+        return export_code_blocks(self.final_code_blocks(), directory)
+
     # Formatting helpers
-    def _format_message(self, role: str, content: str) -> str:
-        role = role.lower()
+    def _format_message(self, message: Dict[str, Any]) -> str:
+        role = message["role"]
+        content = message["content"]
+        blocks = self.code_blocks(message)
         out = []
         title_map = {
             "user": "user",
             "coder": "coder（生成初版代码）",
             "reviewer": "reviewer（改进建议）",
             "integrator": "integrator（融合产出最终代码）",
+            "planner": "planner（文件清单）",
         }
         out.append(f"### {title_map.get(role, role)}\n")
 
         if role == "reviewer":
-            content = _strip_fenced_block_if_list(content)
+            content = _strip_fenced_block_if_list(content, blocks)
             out.append(content.strip() + "\n\n")
             return "".join(out)
 
-        # coder/integrator prefer code fences; preserve if already fenced
-        stripped = content.strip()
-        
-        # Check if content already has code fences
-        has_code_fences = stripped.startswith("```") and stripped.endswith("```")
-        
-        if has_code_fences:
-            # Content already has code fences, clean them and add proper ones
-            cleaned_content = _clean_code_fences(stripped)
-            if _guess_is_code(cleaned_content) or role in {"coder", "integrator"}:
-                out.append("```python\n" + cleaned_content + "\n```\n\n")
-            else:
-                out.append("```\n" + cleaned_content + "\n```\n\n")
-        else:
-            # Content doesn't have code fences, add them based on content type
-            if _guess_is_code(stripped) or role in {"coder", "integrator"}:
-                out.append("```python\n" + stripped + "\n```\n\n")
-            else:
-                out.append("```\n" + stripped + "\n```\n\n")
+        if not blocks:
+            # 没有围栏代码块：按原文包裹为无语言标签的代码块
+            out.append(render_fenced(content.strip()) + "\n\n")
+            return "".join(out)
+
+        # 重新输出每个代码块并保留其语言标签，代码块之间的说明文字原样保留
+        prose = split_prose(content, blocks)
+        for text, block in zip(prose, blocks):
+            if text.strip():
+                out.append(text.strip() + "\n\n")
+            out.append(render_fenced(block.code, block.language) + "\n\n")
+        if prose[-1].strip():
+            out.append(prose[-1].strip() + "\n\n")
         return "".join(out)
 
     def _workflow_check(self) -> str:
@@ -331,15 +397,34 @@ class TaskRecorder:
             except ValueError:
                 return 10 ** 9
 
-        ok_order = (
-                first_index("user") < first_index("coder") < first_index("reviewer") < first_index("integrator")
-        )
+        indices = [first_index(r) for r in self.role_order]
+        ok_order = all(a < b for a, b in zip(indices, indices[1:]))
         lines = ["## 工作流校验\n"]
-        lines.append(f"- 顺序：user → coder → reviewer → integrator（{'符合' if ok_order else '不符合'}预期）。\n")
+        lines.append(f"- 顺序：{' → '.join(self.role_order)}（{'符合' if ok_order else '不符合'}预期）。\n")
         lines.append("- 终止条件：" + (
             "检测到 'TERMINATE' 后停止（符合配置）。\n" if self.terminated_by else "未检测到 TERMINATE。\n"))
         return "".join(lines) + "\n"
 
+    def _prefix_cache_section(self) -> str:
+        stats = self.prefix_cache_stats
+        if not stats or not stats["requests"]:
+            return ""
+        byte_ratio = stats["cached_bytes"] / stats["prompt_bytes"] if stats["prompt_bytes"] else 0.0
+        token_ratio = stats["cached_tokens"] / stats["prompt_tokens"] if stats["prompt_tokens"] else 0.0
+        history = int(stats["index_blocks_at_start"])
+        lines = ["## 提示词前缀缓存\n\n"]
+        lines.append(
+            f"- 统计范围: 运行开始时索引中已有 {history} 个前缀块（来自此前的运行），命中包括跨运行复用\n"
+            if history else "- 统计范围: 运行开始时前缀索引为空，命中仅来自本次运行内部的复用\n"
+        )
+        lines.append(f"- 模型请求数: {int(stats['requests'])}（命中可复用前缀 {int(stats['hits'])} 次）\n")
+        lines.append(f"- 可复用前缀占比（按字节）: {byte_ratio:.1%}\n")
+        lines.append(
+            f"- 可复用前缀 token（估算）: {int(stats['cached_tokens'])} / {int(stats['prompt_tokens'])}"
+            f"（{token_ratio:.1%}）\n\n"
+        )
+        return "".join(lines)
+
     def _appendix_raw(self) -> str:
         # keep concise raw dump
         lines = ["## 附录：原始消息日志（节选）\n\n", "```text\n"]
@@ -363,9 +448,10 @@ class TaskRecorder:
         parts.append("## 执行过程\n\n")
 
         for m in self.messages:
-            parts.append(self._format_message(m["role"], m["content"]))
+            parts.append(self._format_message(m))
 
         parts.append(self._workflow_check())
+        parts.append(self._prefix_cache_section())
         parts.append(self._appendix_raw())
         parts.append("---\n\n此记录由系统自动生成。\n")
         return "".join(parts)
@@ -376,19 +462,153 @@ class TaskRecorder:
             f.write(md)
 
 
-def get_next_execution_number() -> int:
-    """获取下一个执行编号"""
-    # 确保task_md文件夹存在
-    os.makedirs("task_md", exist_ok=True)
-    record_files = glob.glob("task_md/task_record_*.md")
-    if not record_files:
-        return 1
+def get_next_execution_number(output_dir: str = "task_md") -> int:
+    """获取下一个执行编号
+
+    通过独占创建记录文件占位来预留编号，同一进程或多个进程并发运行时不会拿到相同编号。
+    """
+    # 确保输出文件夹存在
+    os.makedirs(output_dir, exist_ok=True)
+    record_files = glob.glob(os.path.join(output_dir, "task_record_*.md"))
     numbers: List[int] = []
     for filename in record_files:
         match = re.match(r"task_record_(\d+)\.md", os.path.basename(filename))
         if match:
             numbers.append(int(match.group(1)))
-    return max(numbers) + 1 if numbers else 1
+    number = max(numbers) + 1 if numbers else 1
+    while True:
+        try:
+            with open(os.path.join(output_dir, f"task_record_{number}.md"), "x", encoding="utf-8"):
+                return number
+        except FileExistsError:
+            number += 1
+
+
+def build_team(
+    agents: List[AssistantAgent],
+    model_client: ChatCompletionClient,
+    use_selector: bool,
+    timeout_seconds: int,
+) -> Union[RoundRobinGroupChat, SelectorGroupChat]:
+    """按参数构建团队；参与者始终保持 coder -> reviewer -> integrator 的顺序。"""
+    termination = build_termination(timeout_seconds)
+    if use_selector:
+        # 使用 SelectorGroupChat - 基于消息内容智能选择下一个发言者
+        return SelectorGroupChat(
+            participants=list(agents),
+            model_client=model_client,
+            termination_condition=termination,
+            selector_func=create_selector_func(),
+            candidate_func=create_candidate_func(),
+            selector_prompt=create_selector_prompt(),
+            allow_repeated_speaker=False  # 不允许同一代理连续发言
+        )
+
+    # 使用 RoundRobinGroupChat - 固定顺序轮流发言
+    return RoundRobinGroupChat(
+        list(agents),
+        termination_condition=termination
+    )
+
+
+async def _set_next_speaker(team: Union[RoundRobinGroupChat, SelectorGroupChat], speaker: str) -> None:
+    """让 RoundRobin 团队从 speaker 开始发言（用于阶段续跑）。
+
+    参与者顺序保持不变，只修改管理器状态中的 next_speaker_index，
+    这样之后 save_state() 保存的索引仍然对应正常顺序，--resume 时不会选错代理。
+    SelectorGroupChat 由 selector_func 根据历史消息选择发言者，无需设置。
+    """
+    if not isinstance(team, RoundRobinGroupChat):
+        return
+    names = [agent.name for agent in team._participants]
+    if speaker not in names:
+        return
+    state = await team.save_state()
+    for agent_state in state["agent_states"].values():
+        if "next_speaker_index" in agent_state:
+            agent_state["next_speaker_index"] = names.index(speaker)
+    await team.load_state(state)
+
+
+def _stop_reason_label(reason: Optional[str]) -> str:
+    """把组合终止条件的停止原因归类为有限的几种，作为指标标签。"""
+    text = (reason or "").lower()
+    if "timeout" in text:
+        return "timeout"
+    if "maximum number of messages" in text:
+        return "max_messages"
+    if "terminate" in text:
+        return "text_mention"
+    if "answered" in text:
+        return "source_match"
+    return "other"
+
+
+def _record_message_metrics(message: BaseChatMessage, elapsed: float) -> None:
+    """记录单个代理回合的耗时与 token 消耗。"""
+    if message.source == "user":
+        return
+    metrics.AGENT_TURN_LATENCY.observe(elapsed, agent=message.source)
+    usage = message.models_usage
+    if usage is not None:
+        metrics.TOKENS.inc(usage.prompt_tokens, agent=message.source, kind="prompt")
+        metrics.TOKENS.inc(usage.completion_tokens, agent=message.source, kind="completion")
+
+
+def _next_speaker(completed: List[BaseChatMessage]) -> str:
+    """根据最后一条完成的消息推断下一个（即失败的）发言者。"""
+    source = completed[-1].source if completed else "user"
+    if source in ROLE_ORDER[:-1]:
+        return ROLE_ORDER[ROLE_ORDER.index(source) + 1]
+    return ROLE_ORDER[1]
+
+
+async def run_team_with_resume(
+    team: Union[RoundRobinGroupChat, SelectorGroupChat],
+    make_team: Callable[[], Union[RoundRobinGroupChat, SelectorGroupChat]],
+    task: str,
+    retry_policy: RetryPolicy,
+    on_message: Callable[[Union[BaseAgentEvent, BaseChatMessage, TaskResult]], None],
+    on_stage_retry: Optional[Callable[[int, BaseException, str], None]] = None,
+) -> Union[RoundRobinGroupChat, SelectorGroupChat]:
+    """运行团队；某个代理回合因瞬时错误失败时，只重跑失败的回合。
+
+    已完成的聊天消息作为任务输入交给 make_team() 新建、并从失败的发言者开始的团队，
+    之前代理的产出不会重新生成。返回最后一次运行所用的团队（用于保存状态）。
+    """
+    completed: List[BaseChatMessage] = []
+    run_task: Union[str, List[BaseChatMessage]] = task
+    attempt = 0
+    while True:
+        # 续跑时团队会先重新输出作为任务输入的历史消息，跳过它们避免重复记录
+        replayed = 0 if isinstance(run_task, str) else len(run_task)
+        turn_started = time.monotonic()
+        try:
+            async for message in team.run_stream(task=run_task):
+                if replayed:
+                    replayed -= 1
+                    continue
+                on_message(message)
+                if isinstance(message, BaseChatMessage):
+                    now = time.monotonic()
+                    _record_message_metrics(message, now - turn_started)
+                    turn_started = now
+                    completed.append(message)
+                elif isinstance(message, TaskResult):
+                    metrics.STOP_REASONS.inc(reason=_stop_reason_label(message.stop_reason))
+            return team
+        except Exception as e:
+            attempt += 1
+            if attempt > retry_policy.stage_retries or not is_retryable(e):
+                raise
+            next_speaker = _next_speaker(completed)
+            metrics.STAGE_RESUMES.inc(agent=next_speaker)
+            if on_stage_retry is not None:
+                on_stage_retry(attempt, e, next_speaker)
+            await asyncio.sleep(retry_policy.backoff(attempt, e))
+            team = make_team()
+            await _set_next_speaker(team, next_speaker)
+            run_task = list(completed) if completed else task
 
 
 async def run_workflow(
@@ -399,7 +619,9 @@ async def run_workflow(
     save_config: bool = False,
     resume_from: Optional[str] = None,
     use_console_ui: bool = True,
-    timeout_seconds: int = 600
+    timeout_seconds: int = 600,
+    retry_policy: Optional[RetryPolicy] = None,
+    output_dir: str = "task_md"
 ) -> None:
     """运行三代理工作流
     
@@ -412,46 +634,32 @@ async def run_workflow(
         resume_from: 从指定状态文件恢复会话（JSON文件路径）
         use_console_ui: 是否使用 AutoGen 的 Console UI
         timeout_seconds: 任务超时时间（秒）
+        retry_policy: 单次调用重试与阶段续跑策略，默认 RetryPolicy()
+        output_dir: 执行记录、状态文件和导出代码的输出目录
     """
+    # 先创建模型客户端：缺少 API Key 时直接退出，不会留下空的占位记录文件
+    retry_policy = retry_policy or RetryPolicy()
+    model_client = build_model_client(api_key=api_key, base_url=base_url, retry_policy=retry_policy)
+
     # 初始化记录器
-    execution_number = get_next_execution_number()
-    record_filename = f"task_md/task_record_{execution_number}.md"
-    state_filename = f"task_md/team_state_{execution_number}.json"
+    execution_number = get_next_execution_number(output_dir)
+    record_filename = os.path.join(output_dir, f"task_record_{execution_number}.md")
+    state_filename = os.path.join(output_dir, f"team_state_{execution_number}.json")
     recorder = TaskRecorder(task, execution_number)
-
-    model_client = build_model_client(api_key=api_key, base_url=base_url)
+    # 统计字典随请求原地更新，写记录时即为本次运行的累计值
+    recorder.prefix_cache_stats = model_client.stats
+    mode = "selector" if use_selector else "round_robin"
+    run_started = metrics.run_started(mode)
     
     try:
         coder, reviewer, integrator = build_agents(model_client)
 
-        # 改进的终止条件 - 组合多种条件提供全面保护
-        termination = (
-            TextMentionTermination("TERMINATE") |           # 检测 TERMINATE 关键词
-            MaxMessageTermination(20) |                     # 最多20条消息防止无限循环
-            TimeoutTermination(timeout_seconds) |           # 超时保护
-            SourceMatchTermination(["integrator"])          # integrator 完成后可结束
-        )
-        
         # 根据参数选择团队类型
         if use_selector:
-            # 使用 SelectorGroupChat - 基于消息内容智能选择下一个发言者
             print("使用 SelectorGroupChat 模式（智能选择）")
-            team = SelectorGroupChat(
-                participants=[coder, reviewer, integrator],
-                model_client=model_client,
-                termination_condition=termination,
-                selector_func=create_selector_func(),
-                candidate_func=create_candidate_func(),
-                selector_prompt=create_selector_prompt(),
-                allow_repeated_speaker=False  # 不允许同一代理连续发言
-            )
         else:
-            # 使用 RoundRobinGroupChat - 固定顺序轮流发言
             print("使用 RoundRobinGroupChat 模式（轮流发言）")
-            team = RoundRobinGroupChat(
-                [coder, reviewer, integrator], 
-                termination_condition=termination
-            )
+        team = build_team([coder, reviewer, integrator], model_client, use_selector, timeout_seconds)
         
         # 如果指定了恢复点，加载之前的状态
         if resume_from and os.path.exists(resume_from):
@@ -459,6 +667,8 @@ async def run_workflow(
             with open(resume_from, "r", encoding="utf-8") as f:
                 saved_state = json.load(f)
             await team.load_state(saved_state)
+            # 恢复的会话历史不在本次运行的消息中，无法据此续跑，仅保留单次调用重试
+            retry_policy = dataclasses.replace(retry_policy, stage_retries=0)
         
         # 保存团队配置
         if save_config:
@@ -475,6 +685,7 @@ async def run_workflow(
                     "types": ["TextMentionTermination", "MaxMessageTermination", "TimeoutTermination", "SourceMatchTermination"],
                     "details": {
                         "text_mention": "TERMINATE",
+                        "text_mention_sources": ["integrator"],
                         "max_messages": 20,
                         "timeout_seconds": timeout_seconds,
                         "source_match": ["integrator"]
@@ -484,7 +695,7 @@ async def run_workflow(
                 "execution_number": execution_number
             }
             
-            config_filename = f"task_md/team_config_{execution_number}.json"
+            config_filename = os.path.join(output_dir, f"team_config_{execution_number}.json")
             with open(config_filename, "w", encoding="utf-8") as f:
                 json.dump(config, f, ensure_ascii=False, indent=2)
             print(f"团队配置已保存到 {config_filename}")
@@ -495,43 +706,49 @@ async def run_workflow(
             print(f"\n{'='*60}")
             print(f"开始执行任务 (执行编号: {execution_number})")
             print(f"{'='*60}\n")
+
+        def on_message(message: Union[BaseAgentEvent, BaseChatMessage, TaskResult]) -> None:
+            # 提取消息信息
+            source = getattr(message, "source", "unknown")
+            
+            # 处理不同类型的消息
+            if isinstance(message, TaskResult):
+                content = f"任务完成 - 停止原因: {message.stop_reason}"
+            else:
+                content = getattr(message, "content", None)
+                if content is None:
+                    content = str(message)
+            
+            # 记录消息
+            recorder.add_message(source, str(content))
             
-            # 使用 Console UI 流式输出，并收集消息用于记录
-            async for message in team.run_stream(task=task):
-                # 提取消息信息
-                source = getattr(message, "source", "unknown")
-                
-                # 处理不同类型的消息
-                if isinstance(message, TaskResult):
-                    content = f"任务完成 - 停止原因: {message.stop_reason}"
-                else:
-                    content = getattr(message, "content", None)
-                    if content is None:
-                        content = str(message)
-                
-                # 记录消息
-                recorder.add_message(source, str(content))
-                
+            preview = content if isinstance(content, str) else str(content)
+            if use_console_ui:
                 # 使用 Console 格式化输出
                 print(f"\n{'─'*60}")
                 print(f"📤 {source}")
                 print(f"{'─'*60}")
-                preview = content if isinstance(content, str) else str(content)
                 print(preview if len(preview) < 3000 else preview[:3000] + "\n... (内容过长，已截断) ...")
-        else:
-            # 使用自定义轻量输出
-            async for message in team.run_stream(task=task):
-                source = getattr(message, "source", "unknown")
-                content = getattr(message, "content", None)
-                if content is None:
-                    content = str(message)
-                recorder.add_message(source, str(content))
-
+            else:
+                # 使用自定义轻量输出
                 print(f"----- {source} -----")
-                preview = content if isinstance(content, str) else str(content)
                 print(preview if len(preview) < 2000 else preview[:2000] + "…")
                 print()
 
+        def on_stage_retry(attempt: int, error: BaseException, next_speaker: str) -> None:
+            note = (
+                f"{next_speaker} 回合失败（{str(error).splitlines()[0]}），"
+                f"从最近完成的回合续跑（第 {attempt}/{retry_policy.stage_retries} 次）"
+            )
+            print(f"\n[WARN] {note}", file=sys.stderr)
+            recorder.add_message("system", note)
+
+        def make_team() -> Union[RoundRobinGroupChat, SelectorGroupChat]:
+            # 续跑使用全新的代理实例，历史消息通过任务输入重放
+            return build_team(list(build_agents(model_client)), model_client, use_selector, timeout_seconds)
+
+        team = await run_team_with_resume(team, make_team, task, retry_policy, on_message, on_stage_retry)
+
         # 保存团队状态（用于可能的恢复）
         team_state = await team.save_state()
         with open(state_filename, "w", encoding="utf-8") as f:
@@ -541,9 +758,17 @@ async def run_workflow(
         # 完成记录
         recorder.finalize()
         recorder.write(record_filename)
-        print(f"执行记录已保存到 {record_filename}\n")
+        print(f"执行记录已保存到 {record_filename}")
+
+        # 导出 integrator 的最终代码，供下游工具直接使用
+        exported = recorder.export_final_code(os.path.join(output_dir, str(execution_number)))
+        for path in exported:
+            print(f"最终代码已导出到 {path}")
+        print()
+        metrics.run_finished(mode, run_started)
         
-    except asyncio.CancelledError:
+    except asyncio.CancelledError as e:
+        metrics.run_finished(mode, run_started, e)
         print("\n任务被用户取消")
         recorder.add_message("system", "任务被用户取消")
         recorder.finalize()
@@ -551,6 +776,7 @@ async def run_workflow(
         raise
         
     except Exception as e:
+        metrics.run_finished(mode, run_started, e)
         print(f"\n执行出错: {e}")
         import traceback
         traceback.print_exc()
@@ -564,6 +790,258 @@ async def run_workflow(
         await model_client.close()
 
 
+# ---- Multi-file Project Generation ----
+def _safe_relative_path(path: str) -> Optional[str]:
+    """规范化清单中的文件路径；绝对路径或越出项目目录的路径返回 None。"""
+    path = path.strip().replace("\\", "/")
+    if not path or path.startswith("/") or re.match(r"^[A-Za-z]:", path):
+        return None
+    normalized = os.path.normpath(path)
+    if normalized.startswith("..") or normalized == ".":
+        return None
+    return normalized
+
+
+def parse_manifest(content: str) -> List[Dict[str, str]]:
+    """从 planner 的输出中解析文件清单。
+
+    优先使用 json 代码块，否则尝试把整段文本当作 JSON；格式错误时抛出 ValueError。
+    """
+    blocks = extract_code_blocks(content)
+    json_blocks = [b for b in blocks if b.language == "json"] or blocks
+    raw = json_blocks[0].code if json_blocks else content
+    try:
+        data = json.loads(raw)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"文件清单不是合法的 JSON: {e}") from e
+
+    entries = data.get("files") if isinstance(data, dict) else data
+    if not isinstance(entries, list) or not entries:
+        raise ValueError("文件清单缺少非空的 files 列表")
+
+    manifest: List[Dict[str, str]] = []
+    seen = set()
+    for entry in entries:
+        if not isinstance(entry, dict) or not isinstance(entry.get("path"), str):
+            raise ValueError(f"无效的清单条目: {entry!r}")
+        path = _safe_relative_path(entry["path"])
+        if path is None:
+            raise ValueError(f"不安全的文件路径: {entry['path']!r}")
+        if path in seen:
+            continue
+        seen.add(path)
+        manifest.append({"path": path, "purpose": str(entry.get("purpose", "")).strip()})
+    if len(manifest) > MAX_MANIFEST_FILES:
+        raise ValueError(f"文件数量 {len(manifest)} 超过上限 {MAX_MANIFEST_FILES}")
+    # 同一路径不能既是文件又是其他文件的父目录（如 "pkg" 与 "pkg/b.py"），否则汇总时无法写入
+    for path in seen:
+        parent = os.path.dirname(path)
+        while parent:
+            if parent in seen:
+                raise ValueError(f"文件路径 {parent!r} 同时是 {path!r} 的父目录")
+            parent = os.path.dirname(parent)
+    return manifest
+
+
+def _file_task(task: str, manifest: List[Dict[str, str]], entry: Dict[str, str]) -> str:
+    """构造单个文件流水线的任务描述；文件相关内容只放在任务里，系统消息保持不变。"""
+    listing = "\n".join(f"- {e['path']}: {e['purpose']}" for e in manifest)
+    return (
+        f"项目总体需求:\n{task.strip()}\n\n"
+        f"项目文件清单:\n{listing}\n\n"
+        f"本次只实现文件 {entry['path']}，职责: {entry['purpose']}\n"
+        "其他文件由其他人并行实现，请严格按照清单中描述的接口与它们交互，只输出该文件的完整内容。"
+    )
+
+
+async def run_file_pipeline(
+    model_client: ChatCompletionClient,
+    task: str,
+    manifest: List[Dict[str, str]],
+    entry: Dict[str, str],
+    execution_number: int,
+    timeout_seconds: int,
+    semaphore: asyncio.Semaphore,
+    retry_policy: RetryPolicy,
+    record_filename: str,
+) -> TaskRecorder:
+    """为单个文件运行 coder -> reviewer -> integrator 流水线，返回该文件的执行记录。
+
+    无论成功与否，执行记录都会写入 record_filename；失败时记录中保留已完成回合的输出，再抛出原异常。
+    """
+    file_task = _file_task(task, manifest, entry)
+    recorder = TaskRecorder(file_task, execution_number)
+
+    def on_message(message: Union[BaseAgentEvent, BaseChatMessage, TaskResult]) -> None:
+        if isinstance(message, TaskResult):
+            recorder.add_message("system", f"任务完成 - 停止原因: {message.stop_reason}")
+            return
+        content = getattr(message, "content", None)
+        recorder.add_message(getattr(message, "source", "unknown"), str(content if content is not None else message))
+
+    def on_stage_retry(attempt: int, error: BaseException, next_speaker: str) -> None:
+        note = f"{next_speaker} 回合失败（{str(error).splitlines()[0]}），从最近完成的回合续跑（第 {attempt} 次）"
+        print(f"[WARN] {entry['path']}: {note}", file=sys.stderr)
+        recorder.add_message("system", note)
+
+    def make_team() -> Union[RoundRobinGroupChat, SelectorGroupChat]:
+        return build_team(list(build_agents(model_client)), model_client, False, timeout_seconds)
+
+    metrics.PIPELINE_QUEUE_DEPTH.inc()
+    try:
+        await semaphore.acquire()
+    finally:
+        metrics.PIPELINE_QUEUE_DEPTH.dec()
+    try:
+        await run_team_with_resume(make_team(), make_team, file_task, retry_policy, on_message, on_stage_retry)
+    except BaseException as e:
+        recorder.add_message("system", f"Error: {type(e).__name__}: {e}")
+        recorder.finalize()
+        try:
+            recorder.write(record_filename)
+        except OSError as write_error:
+            print(f"[WARN] {entry['path']}: 写入执行记录失败: {write_error}", file=sys.stderr)
+        raise
+    finally:
+        semaphore.release()
+    recorder.finalize()
+    recorder.write(record_filename)
+    return recorder
+
+
+async def run_multi_file_workflow(
+    task: str,
+    api_key: Optional[str] = None,
+    base_url: Optional[str] = None,
+    timeout_seconds: int = 600,
+    max_parallel: int = 4,
+    retry_policy: Optional[RetryPolicy] = None,
+    output_dir: str = "task_md",
+) -> int:
+    """多文件规划模式：planner 先输出文件清单，再为每个文件并发运行三代理流水线。
+
+    端到端耗时接近最慢的单个文件，而不是所有文件之和。产物汇总到 task_md/N/project/。
+    返回生成失败的文件数。
+
+    Args:
+        task: 用户的开发需求
+        api_key: Mistral API Key
+        base_url: Mistral API Base URL
+        timeout_seconds: 每个阶段（规划、单文件流水线）的超时时间（秒）
+        max_parallel: 同时运行的文件流水线数量上限
+        retry_policy: 单次调用重试与阶段续跑策略，默认 RetryPolicy()
+        output_dir: 执行记录与项目产物的输出目录
+    """
+    # 先创建模型客户端：缺少 API Key 时直接退出，不会留下空的占位记录文件
+    retry_policy = retry_policy or RetryPolicy()
+    model_client = build_model_client(api_key=api_key, base_url=base_url, retry_policy=retry_policy)
+
+    execution_number = get_next_execution_number(output_dir)
+    record_filename = os.path.join(output_dir, f"task_record_{execution_number}.md")
+    project_dir = os.path.join(output_dir, str(execution_number), "project")
+    records_dir = os.path.join(output_dir, str(execution_number), "records")
+    recorder = TaskRecorder(task, execution_number)
+    recorder.role_order = ["user", "planner"]
+    # 统计字典随请求原地更新，写记录时即为本次运行的累计值
+    recorder.prefix_cache_stats = model_client.stats
+    mode = "multi_file"
+    run_started = metrics.run_started(mode)
+
+    try:
+        print(f"\n{'='*60}")
+        print(f"开始执行多文件任务 (执行编号: {execution_number})")
+        print(f"{'='*60}\n")
+
+        # 1. 规划：生成文件清单
+        planner = build_planner(model_client)
+        recorder.add_message("user", task)
+        planning_started = time.monotonic()
+        result = await asyncio.wait_for(planner.run(task=task), timeout=timeout_seconds)
+        plan = result.messages[-1]
+        if isinstance(plan, BaseChatMessage):
+            _record_message_metrics(plan, time.monotonic() - planning_started)
+        plan_content = str(getattr(plan, "content", plan))
+        recorder.add_message("planner", plan_content)
+        manifest = parse_manifest(plan_content)
+        print(f"文件清单（{len(manifest)} 个文件）:")
+        for entry in manifest:
+            print(f"  - {entry['path']}: {entry['purpose']}")
+
+        # 2. 每个文件独立运行 coder -> reviewer -> integrator，并发执行
+        os.makedirs(records_dir, exist_ok=True)
+        record_files = [
+            os.path.join(records_dir, f"{i}_{os.path.basename(entry['path'])}.md")
+            for i, entry in enumerate(manifest, start=1)
+        ]
+        semaphore = asyncio.Semaphore(max(1, max_parallel))
+        results = await asyncio.gather(
+            *(
+                run_file_pipeline(
+                    model_client, task, manifest, entry, execution_number, timeout_seconds, semaphore, retry_policy,
+                    file_record,
+                )
+                for entry, file_record in zip(manifest, record_files)
+            ),
+            return_exceptions=True,
+        )
+
+        # 3. 汇总到项目目录
+        summary: List[str] = []
+        failed = 0
+        for entry, file_record, outcome in zip(manifest, record_files, results):
+            if isinstance(outcome, BaseException):
+                failed += 1
+                summary.append(f"- {entry['path']}: 失败（{outcome}，部分记录见 {file_record}）")
+                continue
+            blocks = outcome.final_code_blocks()
+            if not blocks:
+                failed += 1
+                summary.append(f"- {entry['path']}: 失败（integrator 未输出代码块，见 {file_record}）")
+                continue
+            target = os.path.join(project_dir, entry["path"])
+            try:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                with open(target, "w", encoding="utf-8") as f:
+                    f.write(blocks[0].code.rstrip("\n") + "\n")
+            except OSError as e:
+                failed += 1
+                summary.append(f"- {entry['path']}: 失败（写入 {target} 出错: {e}）")
+                continue
+            summary.append(f"- {entry['path']}: 已生成（记录见 {file_record}）")
+
+        recorder.add_message("system", "多文件生成结果:\n" + "\n".join(summary))
+        print("\n".join(summary))
+        print(f"\n项目文件已汇总到 {project_dir}（失败 {failed} / {len(manifest)}）")
+
+        recorder.finalize()
+        recorder.write(record_filename)
+        print(f"执行记录已保存到 {record_filename}\n")
+        # 部分文件失败时 CLI 以非零状态退出，指标中同样计为失败
+        metrics.run_finished(mode, run_started, "PartialFailure" if failed else None)
+        return failed
+
+    except asyncio.CancelledError as e:
+        metrics.run_finished(mode, run_started, e)
+        print("\n任务被用户取消")
+        recorder.add_message("system", "任务被用户取消")
+        recorder.finalize()
+        recorder.write(record_filename)
+        raise
+
+    except Exception as e:
+        metrics.run_finished(mode, run_started, e)
+        print(f"\n执行出错: {e}")
+        import traceback
+        traceback.print_exc()
+        recorder.add_message("system", f"Error: {str(e)}\n{traceback.format_exc()}")
+        recorder.finalize()
+        recorder.write(record_filename)
+        raise
+
+    finally:
+        await model_client.close()
+
+
 def parse_args(argv: List[str]) -> argparse.Namespace:
     parser = argparse.ArgumentParser(
         description="3-Agent AutoGen 工作流: coder -> reviewer -> integrator",
@@ -582,6 +1060,9 @@ def parse_args(argv: List[str]) -> argparse.Namespace:
   # 从之前的状态恢复
   python improved_three_agent_workflow.py --resume task_md/team_state_1.json
   
+  # 多文件项目：先生成文件清单，再按文件并发生成
+  python improved_three_agent_workflow.py --task "REST API客户端及其单元测试" --multi-file --max-parallel 4
+
   # 自定义超时和禁用Console UI
   python improved_three_agent_workflow.py --task "数据分析脚本" --timeout 300 --no-console-ui
         """
@@ -634,6 +1115,58 @@ def parse_args(argv: List[str]) -> argparse.Namespace:
         default=600,
         help="任务执行超时时间（秒），默认600秒（10分钟）",
     )
+    parser.add_argument(
+        "--max-retries",
+        dest="max_retries",
+        type=int,
+        default=3,
+        help="单次模型调用遇到超时、5xx、限流、连接中断等瞬时错误时的最大重试次数（指数退避），默认3",
+    )
+    parser.add_argument(
+        "--stage-retries",
+        dest="stage_retries",
+        type=int,
+        default=2,
+        help="某个代理回合最终失败后，从最近完成的回合续跑的最大次数（不重跑已完成的代理），默认2",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        dest="metrics_port",
+        type=int,
+        default=None,
+        help=(
+            "在 127.0.0.1 的指定端口以 Prometheus 格式暴露运行指标（/metrics）。服务随进程退出而关闭，"
+            "只反映运行中的指标；运行完成/失败次数与整次耗时请使用 --metrics-textfile"
+        ),
+    )
+    parser.add_argument(
+        "--metrics-textfile",
+        dest="metrics_textfile",
+        default=None,
+        help=(
+            "运行结束后把 Prometheus 格式指标（含运行结果与耗时）写入该文件（用于 node_exporter textfile collector）；"
+            "计数器和直方图与文件中已有的值累加，跨运行累计"
+        ),
+    )
+    parser.add_argument(
+        "--prefix-cache-file",
+        dest="prefix_cache_file",
+        default=PREFIX_CACHE_FILE,
+        help=f"提示词前缀索引的持久化文件，使前缀复用统计覆盖多次运行；传空字符串则不持久化，默认 {PREFIX_CACHE_FILE}",
+    )
+    parser.add_argument(
+        "--multi-file",
+        dest="multi_file",
+        action="store_true",
+        help="多文件规划模式：先输出文件清单，再为每个文件并发运行 coder -> reviewer -> integrator",
+    )
+    parser.add_argument(
+        "--max-parallel",
+        dest="max_parallel",
+        type=int,
+        default=4,
+        help="多文件模式下同时运行的文件流水线数量上限，默认4",
+    )
     return parser.parse_args(argv)
 
 
@@ -662,6 +1195,46 @@ def main(argv: List[str]) -> int:
             print("[ERROR] 必须提供开发需求 --task 或在提示符输入。", file=sys.stderr)
             return 2
     
+    retry_policy = RetryPolicy(max_retries=args.max_retries, stage_retries=args.stage_retries)
+
+    if args.metrics_port:
+        metrics.start_http_server(args.metrics_port)
+        print(f"运行指标: http://127.0.0.1:{args.metrics_port}/metrics")
+    if args.prefix_cache_file:
+        # 加载此前运行保存的前缀索引，使执行记录中的前缀复用统计覆盖跨运行的复用
+        DEFAULT_PREFIX_CACHE.load(args.prefix_cache_file)
+    try:
+        return _run_from_args(args, task, retry_policy)
+    finally:
+        # 只在本次运行写入过新块时保存：启动失败（如缺少 API Key）不应留下任何文件
+        if args.prefix_cache_file and DEFAULT_PREFIX_CACHE.modified:
+            try:
+                DEFAULT_PREFIX_CACHE.save(args.prefix_cache_file)
+            except OSError as e:
+                print(f"[WARN] 保存前缀索引失败: {e}", file=sys.stderr)
+        if args.metrics_textfile:
+            metrics.write_textfile(args.metrics_textfile, merge=True)
+
+
+def _run_from_args(args: argparse.Namespace, task: str, retry_policy: RetryPolicy) -> int:
+    """按命令行参数选择并运行工作流。"""
+    if args.multi_file:
+        if args.resume_from or args.use_selector:
+            print("[ERROR] --multi-file 不支持与 --resume 或 --use-selector 同时使用。", file=sys.stderr)
+            return 2
+        failed = asyncio.run(run_multi_file_workflow(
+            task=task,
+            api_key=args.mistral_api_key,
+            base_url=args.mistral_base_url,
+            timeout_seconds=args.timeout_seconds,
+            max_parallel=args.max_parallel,
+            retry_policy=retry_policy
+        ))
+        if failed:
+            print(f"[ERROR] {failed} 个文件生成失败。", file=sys.stderr)
+            return 1
+        return 0
+
     asyncio.run(run_workflow(
         task=task, 
         api_key=args.mistral_api_key, 
@@ -670,7 +1243,8 @@ def main(argv: List[str]) -> int:
         save_config=args.save_config,
         resume_from=args.resume_from,
         use_console_ui=not args.no_console_ui,
-        timeout_seconds=args.timeout_seconds
+        timeout_seconds=args.timeout_seconds,
+        retry_policy=retry_policy
     ))
     return 0
 
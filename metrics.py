@@ -0,0 +1,355 @@
+"""Prometheus 文本格式的运行指标。
+
+不依赖 prometheus_client：内置最小的 Counter / Gauge / Histogram 实现，
+可以通过本地 HTTP 端口暴露（start_http_server），也可以写入 node_exporter 的
+textfile collector 目录（write_textfile）。
+"""
+
+import bisect
+import contextlib
+import math
+import os
+import tempfile
+import threading
+import time
+from abc import ABC, abstractmethod
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None  # type: ignore[assignment]
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# 代理回合、整次运行的耗时分桶（秒）
+LATENCY_BUCKETS = (0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric(ABC):
+    kind = ""
+    # 写入 textfile 时能否与文件中已有的值累加（计数器、直方图可以，瞬时值不行）
+    cumulative = False
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} 需要标签 {self.labelnames}，实际为 {tuple(labels)}")
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    @abstractmethod
+    def _samples(self) -> List[str]:
+        """返回该指标的样本行（不含 HELP / TYPE）。"""
+
+    def sample_names(self) -> Tuple[str, ...]:
+        """该指标输出的样本名（直方图带 _bucket / _sum / _count 后缀）。"""
+        return (self.name,)
+
+    def render(self, previous: Optional[Dict[str, float]] = None) -> str:
+        """生成文本格式输出；previous 为此前写出的样本值时，可累加的指标会与其相加。"""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        samples = self._samples()
+        if previous and self.cumulative:
+            samples = self._merge(samples, previous)
+        lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+    def _merge(self, samples: List[str], previous: Dict[str, float]) -> List[str]:
+        merged: Dict[str, float] = {}
+        for line in samples:
+            key, _, value = line.rpartition(" ")
+            merged[key] = float(value)
+        names = self.sample_names()
+        for key, value in previous.items():
+            if key.split("{", 1)[0] in names:
+                merged[key] = merged.get(key, 0.0) + value
+        return [f"{key} {_format_value(value)}" for key, value in merged.items()]
+
+
+class _ScalarMetric(_Metric):
+    """每组标签对应一个数值的指标（Counter / Gauge 的公共实现）。"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        # 无标签的指标从 0 开始输出，便于告警规则区分"没有数据"和"值为 0"
+        self._values: Dict[Tuple[str, ...], float] = {} if self.labelnames else {(): 0.0}
+
+    def _add(self, amount: float, labels: Dict[str, str]) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: str) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0.0)
+
+    def total(self) -> float:
+        """所有标签组合的值之和。"""
+        with self._lock:
+            return sum(self._values.values())
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}" for k, v in items]
+
+
+class Counter(_ScalarMetric):
+    """单调递增计数器。"""
+
+    kind = "counter"
+    cumulative = True
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        if amount < 0:
+            raise ValueError("Counter 只能递增")
+        self._add(amount, labels)
+
+
+class Gauge(_ScalarMetric):
+    """可增可减的瞬时值。"""
+
+    kind = "gauge"
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = float(value)
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        self._add(amount, labels)
+
+    def dec(self, amount: float = 1.0, **labels: str) -> None:
+        self._add(-amount, labels)
+
+
+class Histogram(_Metric):
+    """累积分桶直方图。"""
+
+    kind = "histogram"
+    cumulative = True
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # 每组标签: (各分桶计数, 总和, 总数)
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], float, int]] = {}
+
+    def sample_names(self) -> Tuple[str, ...]:
+        return (f"{self.name}_bucket", f"{self.name}_sum", f"{self.name}_count")
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total, count = self._values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            if index < len(counts):
+                counts[index] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = sorted((k, (list(c), s, n)) for k, (c, s, n) in self._values.items())
+        lines: List[str] = []
+        inf = 'le="+Inf"'
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, inf)} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class Registry:
+    """指标注册表，负责生成 Prometheus 文本格式输出。"""
+
+    def __init__(self) -> None:
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"指标 {metric.name} 已注册")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self, previous: Optional[Dict[str, float]] = None) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "".join(m.render(previous) for m in metrics)
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+    return REGISTRY.register(Counter(name, documentation, labelnames))  # type: ignore[return-value]
+
+
+def gauge(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+    return REGISTRY.register(Gauge(name, documentation, labelnames))  # type: ignore[return-value]
+
+
+def histogram(
+    name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS
+) -> Histogram:
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))  # type: ignore[return-value]
+
+
+# ---- Workflow Metrics ----
+RUNS_STARTED = counter("autogen_workflow_runs_started_total", "已启动的工作流运行次数", ["mode"])
+RUNS_COMPLETED = counter("autogen_workflow_runs_completed_total", "成功完成的工作流运行次数", ["mode"])
+RUNS_FAILED = counter("autogen_workflow_runs_failed_total", "失败或被取消的工作流运行次数", ["mode", "error"])
+RUN_DURATION = histogram("autogen_workflow_run_duration_seconds", "整次工作流运行耗时（秒）", ["mode"])
+RUNS_IN_PROGRESS = gauge("autogen_workflow_runs_in_progress", "正在执行的工作流数量", ["mode"])
+STOP_REASONS = counter("autogen_workflow_stop_reason_total", "团队停止原因分布", ["reason"])
+AGENT_TURN_LATENCY = histogram("autogen_agent_turn_seconds", "单个代理回合耗时（秒）", ["agent"])
+TOKENS = counter("autogen_tokens_total", "模型调用消耗的 token 数", ["agent", "kind"])
+CACHE_REQUESTS = counter("autogen_cache_requests_total", "缓存查询次数（按命中/未命中）", ["cache", "result"])
+PROMPT_PREFIX_TOKENS = counter(
+    "autogen_prompt_prefix_tokens_total", "提示词 token 数及其中可复用前缀的 token 数（估算）", ["kind"]
+)
+MODEL_CALL_RETRIES = counter("autogen_model_call_retries_total", "单次模型调用的重试次数", ["error"])
+STAGE_RESUMES = counter("autogen_stage_resumes_total", "代理回合失败后的阶段续跑次数", ["agent"])
+PIPELINE_QUEUE_DEPTH = gauge("autogen_file_pipelines_queued", "多文件模式下等待执行的文件流水线数量")
+
+
+# ---- Exposition ----
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry: Registry = REGISTRY
+
+    def do_GET(self) -> None:  # noqa: N802
+        if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: object) -> None:
+        # 抓取请求很频繁，不输出访问日志
+        pass
+
+
+def start_http_server(port: int, addr: str = "127.0.0.1", registry: Registry = REGISTRY) -> ThreadingHTTPServer:
+    """在后台线程中通过 HTTP 暴露指标（/metrics），返回 server 以便调用方 shutdown()。"""
+    handler = type("MetricsHandler", (_MetricsHandler,), {"registry": registry})
+    server = ThreadingHTTPServer((addr, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True)
+    thread.start()
+    return server
+
+
+def _read_samples(path: str) -> Dict[str, float]:
+    """读取此前写出的文本格式文件，返回 {样本名与标签: 值}；文件不存在时返回空字典。"""
+    samples: Dict[str, float] = {}
+    try:
+        with open(path, encoding="utf-8") as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return samples
+    for line in lines:
+        if not line or line.startswith("#"):
+            continue
+        key, _, value = line.rpartition(" ")
+        try:
+            samples[key] = float(value)
+        except ValueError:
+            continue
+    return samples
+
+
+@contextlib.contextmanager
+def _file_lock(path: str) -> Iterator[None]:
+    """用旁路锁文件串行化多个进程的读-改-写；没有 fcntl 的平台（Windows）不加锁。"""
+    if fcntl is None:
+        yield
+        return
+    with open(path, "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def write_textfile(path: str, registry: Registry = REGISTRY, merge: bool = False) -> None:
+    """原子地写入 textfile collector 文件（先写临时文件再重命名，避免被读到半个文件）。
+
+    merge 为 True 时，计数器和直方图与文件中已有的值累加，使每次只运行一次的命令行进程
+    也能在文件中累积出跨运行的总数，increase() / rate() 因而可用；瞬时值（gauge）以本进程为准。
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    with _file_lock(path + ".lock") if merge else contextlib.nullcontext():
+        previous = _read_samples(path) if merge else None
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".metrics-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(registry.render(previous))
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+def run_started(mode: str) -> float:
+    """记录一次运行开始，返回开始时间供 run_finished 使用。"""
+    RUNS_STARTED.inc(mode=mode)
+    RUNS_IN_PROGRESS.inc(mode=mode)
+    return time.monotonic()
+
+
+def run_finished(mode: str, started: float, error: Union[BaseException, str, None] = None) -> None:
+    """记录一次运行结束；error 不为 None 时计为失败。
+
+    error 可以是异常（以类型名作为标签），也可以是直接作为标签的字符串（如 "PartialFailure"）。
+    """
+    RUNS_IN_PROGRESS.dec(mode=mode)
+    RUN_DURATION.observe(time.monotonic() - started, mode=mode)
+    if error is None:
+        RUNS_COMPLETED.inc(mode=mode)
+    else:
+        RUNS_FAILED.inc(mode=mode, error=error if isinstance(error, str) else type(error).__name__)
+
+
+def observe_cache(cache: str, hit: bool) -> None:
+    CACHE_REQUESTS.inc(cache=cache, result="hit" if hit else "miss")
@@ -0,0 +1,382 @@
+"""模型客户端包装：单次调用级别的重试策略与提示词前缀缓存。
+
+RetryingChatCompletionClient 包装任意 ChatCompletionClient，在超时、5xx、限流、连接中断等
+瞬时错误时按指数退避重试单次模型调用；其余错误直接抛出。
+
+PrefixCachingChatCompletionClient 在每次请求前查询 PrefixCache（按块链式哈希的本地前缀索引，
+与推理服务的 KV 前缀缓存同构），统计请求中可复用的前缀比例，并可通过 request_hints 钩子
+为支持前缀缓存的服务附加请求参数。索引可以用 save() / load() 持久化，使复用统计覆盖多次运行。
+"""
+
+import asyncio
+import hashlib
+import os
+import random
+import sys
+import tempfile
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, AsyncGenerator, Dict, List, Optional, Sequence, Union
+
+import openai
+from autogen_core.models import ChatCompletionClient, CreateResult, LLMMessage, ModelCapabilities, ModelInfo, RequestUsage
+
+import metrics
+
+# 视为瞬时错误、可以重试的异常类型
+RETRYABLE_EXCEPTIONS = (
+    openai.APIConnectionError,  # 包含 APITimeoutError 以及底层 HTTP 传输错误
+    openai.RateLimitError,
+    openai.InternalServerError,
+    asyncio.TimeoutError,
+    ConnectionError,
+)
+
+# 团队运行出错时异常会被序列化为 "类型名: 消息" 的 RuntimeError，按类型名识别瞬时错误
+RETRYABLE_ERROR_NAMES = frozenset(
+    cls.__name__
+    for base in RETRYABLE_EXCEPTIONS
+    for cls in [base, *base.__subclasses__()]
+) | {"TimeoutError", "ReadTimeout", "ConnectTimeout", "RemoteProtocolError", "ConnectError", "ReadError"}
+
+RETRYABLE_STATUS_CODES = frozenset({408, 409, 429})
+
+
+@dataclass
+class RetryPolicy:
+    """重试策略。
+
+    max_retries 是单次模型调用的最大重试次数；stage_retries 是某个代理回合失败后，
+    从最近一次完成的回合续跑的最大次数。退避时间为 initial_backoff * 2^(attempt-1)，
+    不超过 max_backoff，并附加 jitter 比例的随机抖动。
+    """
+
+    max_retries: int = 3
+    stage_retries: int = 2
+    initial_backoff: float = 1.0
+    max_backoff: float = 30.0
+    jitter: float = 0.1
+
+    def backoff(self, attempt: int, error: Optional[BaseException] = None) -> float:
+        delay = min(self.max_backoff, self.initial_backoff * (2 ** max(0, attempt - 1)))
+        retry_after = _retry_after_seconds(error)
+        if retry_after is not None:
+            delay = min(self.max_backoff, max(delay, retry_after))
+        return delay * (1 + random.uniform(0, self.jitter))
+
+
+def _retry_after_seconds(error: Optional[BaseException]) -> Optional[float]:
+    """读取限流响应中的 Retry-After 头（秒）。"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get("retry-after", ""))
+    except ValueError:
+        return None
+
+
+def is_retryable(error: BaseException) -> bool:
+    """判断异常是否为可重试的瞬时错误。"""
+    if isinstance(error, RETRYABLE_EXCEPTIONS):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS_CODES or error.status_code >= 500
+    if isinstance(error, RuntimeError):
+        # 团队运行时把参与者抛出的异常包装成 RuntimeError("类型名: 消息")
+        error_type = str(error).split(":", 1)[0].strip()
+        return error_type in RETRYABLE_ERROR_NAMES
+    return False
+
+
+class _WrappedChatCompletionClient(ChatCompletionClient):
+    """把除 create / create_stream 以外的接口透传给被包装客户端的基类。"""
+
+    def __init__(self, client: ChatCompletionClient) -> None:
+        self._client = client
+
+    async def close(self) -> None:
+        await self._client.close()
+
+    def actual_usage(self) -> RequestUsage:
+        return self._client.actual_usage()
+
+    def total_usage(self) -> RequestUsage:
+        return self._client.total_usage()
+
+    def count_tokens(self, messages: Sequence[LLMMessage], **kwargs: Any) -> int:
+        return self._client.count_tokens(messages, **kwargs)
+
+    def remaining_tokens(self, messages: Sequence[LLMMessage], **kwargs: Any) -> int:
+        return self._client.remaining_tokens(messages, **kwargs)
+
+    @property
+    def capabilities(self) -> ModelCapabilities:  # type: ignore[override]
+        return self._client.capabilities
+
+    @property
+    def model_info(self) -> ModelInfo:
+        return self._client.model_info
+
+    def __getattr__(self, name: str) -> Any:
+        # 其余属性透传给被包装的客户端
+        if name == "_client":
+            raise AttributeError(name)
+        return getattr(self._client, name)
+
+
+class RetryingChatCompletionClient(_WrappedChatCompletionClient):
+    """按 RetryPolicy 重试单次模型调用的客户端包装。"""
+
+    def __init__(self, client: ChatCompletionClient, policy: RetryPolicy) -> None:
+        super().__init__(client)
+        self._policy = policy
+
+    async def _sleep_before_retry(self, attempt: int, error: BaseException) -> None:
+        delay = self._policy.backoff(attempt, error)
+        metrics.MODEL_CALL_RETRIES.inc(error=type(error).__name__)
+        print(
+            f"[WARN] 模型调用失败（{type(error).__name__}: {error}），"
+            f"{delay:.1f} 秒后进行第 {attempt}/{self._policy.max_retries} 次重试",
+            file=sys.stderr,
+        )
+        await asyncio.sleep(delay)
+
+    async def create(self, messages: Sequence[LLMMessage], **kwargs: Any) -> CreateResult:
+        attempt = 0
+        while True:
+            try:
+                return await self._client.create(messages, **kwargs)
+            except Exception as e:
+                attempt += 1
+                if attempt > self._policy.max_retries or not is_retryable(e):
+                    raise
+                await self._sleep_before_retry(attempt, e)
+
+    async def create_stream(
+        self, messages: Sequence[LLMMessage], **kwargs: Any
+    ) -> AsyncGenerator[Union[str, CreateResult], None]:
+        attempt = 0
+        while True:
+            started = False
+            try:
+                async for chunk in self._client.create_stream(messages, **kwargs):
+                    started = True
+                    yield chunk
+                return
+            except Exception as e:
+                attempt += 1
+                # 已经输出过部分内容时不能透明重试，否则调用方会收到重复片段
+                if started or attempt > self._policy.max_retries or not is_retryable(e):
+                    raise
+                await self._sleep_before_retry(attempt, e)
+
+
+@dataclass
+class PrefixLookup:
+    """一次前缀缓存查询的结果。"""
+
+    prefix_key: str
+    prompt_bytes: int
+    cached_bytes: int
+
+    @property
+    def ratio(self) -> float:
+        return self.cached_bytes / self.prompt_bytes if self.prompt_bytes else 0.0
+
+
+def serialize_messages(messages: Sequence[LLMMessage]) -> str:
+    """把请求消息序列化为确定的字符串，用于前缀比较。"""
+    parts: List[str] = []
+    for message in messages:
+        content = message.content if isinstance(message.content, str) else repr(message.content)
+        parts.append(f"{type(message).__name__}\x1f{getattr(message, 'source', '')}\x1f{content}\x1e")
+    return "".join(parts)
+
+
+# 持久化索引文件的格式标识，其后是 4 字节的 block_size 和按 LRU 顺序排列的块键
+_INDEX_MAGIC = b"PFXIDX1\n"
+_KEY_SIZE = 16
+
+
+class PrefixCache:
+    """KV 风格的本地前缀缓存索引。
+
+    请求按 UTF-8 编码后每 block_size 个字节切块，每块的键是"前一块的键 + 本块内容"的哈希，
+    因此只有从头开始完全一致的前缀才会命中。索引以 LRU 方式保留最多 max_blocks 个块，
+    可通过 save() / load() 在多次运行之间保留。每个请求只索引前 max_indexed_blocks 个块
+    （默认 max_blocks 的四分之一），单个超大请求不会把索引中的其他前缀（如团队公共前言）全部挤出。
+    子类可以重写 request_hints，为支持前缀缓存的推理服务附加请求参数
+    （例如 llama.cpp 的 cache_prompt 或 OpenAI 的 prompt_cache_key）。
+    """
+
+    def __init__(self, block_size: int = 64, max_blocks: int = 50_000, max_indexed_blocks: Optional[int] = None) -> None:
+        self.block_size = block_size
+        self.max_blocks = max_blocks
+        self.max_indexed_blocks = max_indexed_blocks or max(1, max_blocks // 4)
+        self._blocks: "OrderedDict[bytes, None]" = OrderedDict()
+        self._lock = threading.Lock()
+        # 自创建或上次 save() 以来查询是否写入过新的块
+        self.modified = False
+
+    def lookup(self, messages: Sequence[LLMMessage]) -> PrefixLookup:
+        """返回请求中已缓存的前缀长度，并把本次请求前 max_indexed_blocks 个完整块写入索引。
+
+        超出索引范围的部分按未缓存计算。哈希整个请求可能较慢，异步调用方应放到线程中执行。
+        """
+        text = serialize_messages(messages)
+        data = text.encode("utf-8")
+        keys: List[bytes] = []
+        digest = b""
+        end = min(len(data), self.max_indexed_blocks * self.block_size)
+        for start in range(0, end - self.block_size + 1, self.block_size):
+            digest = hashlib.blake2b(digest + data[start:start + self.block_size], digest_size=_KEY_SIZE).digest()
+            keys.append(digest)
+
+        with self._lock:
+            cached = 0
+            for key in keys:
+                if key not in self._blocks:
+                    break
+                cached += 1
+            if cached < len(keys):
+                self.modified = True
+            # 从后往前刷新，使链首的块最新、最后被淘汰：链首一旦被淘汰，后面的块再也无法命中
+            for key in reversed(keys):
+                self._blocks[key] = None
+                self._blocks.move_to_end(key)
+            while len(self._blocks) > self.max_blocks:
+                self._blocks.popitem(last=False)
+
+        first = serialize_messages(messages[:1]).encode("utf-8")
+        return PrefixLookup(
+            prefix_key=hashlib.blake2b(first, digest_size=8).hexdigest(),
+            prompt_bytes=len(data),
+            cached_bytes=min(len(data), cached * self.block_size),
+        )
+
+    def request_hints(self, lookup: PrefixLookup) -> Dict[str, Any]:
+        """返回附加到请求 extra_create_args 的参数；默认不附加任何参数。"""
+        return {}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._blocks.clear()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._blocks)
+
+    def _header(self) -> bytes:
+        return _INDEX_MAGIC + self.block_size.to_bytes(4, "big")
+
+    def load(self, path: str) -> int:
+        """加载 save() 写入的索引，返回新加入的块数；文件不存在或格式不符时返回 0。
+
+        文件中的块视为比内存中已有的块更旧，LRU 淘汰时优先淘汰。
+        """
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return 0
+        header = self._header()
+        if not data.startswith(header) or (len(data) - len(header)) % _KEY_SIZE:
+            return 0
+        keys = [data[i:i + _KEY_SIZE] for i in range(len(header), len(data), _KEY_SIZE)]
+        added = 0
+        with self._lock:
+            # 文件按从旧到新排列，倒序插到 LRU 队首后仍保持原有的先后顺序
+            for key in reversed(keys):
+                if key not in self._blocks:
+                    self._blocks[key] = None
+                    self._blocks.move_to_end(key, last=False)
+                    added += 1
+            while len(self._blocks) > self.max_blocks:
+                self._blocks.popitem(last=False)
+        return added
+
+    def save(self, path: str) -> None:
+        """把索引原子地写入 path（先写临时文件再重命名）。
+
+        写入前先合并文件中已有的块，多个进程先后保存时尽量不丢失彼此的索引。
+        """
+        self.load(path)
+        with self._lock:
+            keys = b"".join(self._blocks)
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".prefix-cache-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(self._header())
+                f.write(keys)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self.modified = False
+
+
+# 进程内共享的前缀缓存，使同一进程中多次运行之间的稳定前缀可以相互复用；
+# 命令行每次启动都是新进程，需要通过 load() / save() 跨进程保留
+DEFAULT_PREFIX_CACHE = PrefixCache()
+
+
+class PrefixCachingChatCompletionClient(_WrappedChatCompletionClient):
+    """在每次模型调用前查询 PrefixCache，并统计可复用前缀占比的客户端包装。
+
+    前缀字节数按比例折算为 token：cached_tokens ≈ prompt_tokens * cached_bytes / prompt_bytes。
+    stats["index_blocks_at_start"] 是创建客户端时索引中已有的块数（来自此前的运行）。
+    """
+
+    def __init__(self, client: ChatCompletionClient, cache: Optional[PrefixCache] = None) -> None:
+        super().__init__(client)
+        self._cache = cache if cache is not None else DEFAULT_PREFIX_CACHE
+        self.stats: Dict[str, float] = {
+            "index_blocks_at_start": len(self._cache),
+            "requests": 0,
+            "hits": 0,
+            "prompt_bytes": 0,
+            "cached_bytes": 0,
+            "prompt_tokens": 0,
+            "cached_tokens": 0,
+        }
+
+    async def _before_call(self, messages: Sequence[LLMMessage], kwargs: Dict[str, Any]) -> PrefixLookup:
+        # 多 MB 的请求哈希需要上百毫秒，放到线程中执行，避免阻塞事件循环
+        lookup = await asyncio.to_thread(self._cache.lookup, messages)
+        hints = self._cache.request_hints(lookup)
+        if hints:
+            kwargs["extra_create_args"] = {**hints, **dict(kwargs.get("extra_create_args") or {})}
+        metrics.observe_cache("prompt_prefix", lookup.cached_bytes > 0)
+        self.stats["requests"] += 1
+        self.stats["hits"] += lookup.cached_bytes > 0
+        self.stats["prompt_bytes"] += lookup.prompt_bytes
+        self.stats["cached_bytes"] += lookup.cached_bytes
+        return lookup
+
+    def _after_call(self, lookup: PrefixLookup, result: CreateResult) -> None:
+        prompt_tokens = result.usage.prompt_tokens
+        cached_tokens = round(prompt_tokens * lookup.ratio)
+        self.stats["prompt_tokens"] += prompt_tokens
+        self.stats["cached_tokens"] += cached_tokens
+        metrics.PROMPT_PREFIX_TOKENS.inc(prompt_tokens, kind="prompt")
+        metrics.PROMPT_PREFIX_TOKENS.inc(cached_tokens, kind="cached")
+
+    async def create(self, messages: Sequence[LLMMessage], **kwargs: Any) -> CreateResult:
+        lookup = await self._before_call(messages, kwargs)
+        result = await self._client.create(messages, **kwargs)
+        self._after_call(lookup, result)
+        return result
+
+    async def create_stream(
+        self, messages: Sequence[LLMMessage], **kwargs: Any
+    ) -> AsyncGenerator[Union[str, CreateResult], None]:
+        lookup = await self._before_call(messages, kwargs)
+        async for chunk in self._client.create_stream(messages, **kwargs):
+            if isinstance(chunk, CreateResult):
+                self._after_call(lookup, chunk)
+            yield chunk
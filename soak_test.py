@@ -0,0 +1,352 @@
+"""负载 / 浸泡测试：在同一进程中反复运行 run_workflow，检测资源泄漏。
+
+在子进程中启动一个本地的 OpenAI 兼容桩服务（按系统消息中的角色返回固定回复），
+然后以可配置的并发度驱动 run_workflow 共 N 次，定期采样 RSS、打开的文件描述符、
+打开的 socket 和未完成的 asyncio 任务数。结束时相对预热后基线的增长超过阈值时以非零状态退出。
+
+桩服务可以按比例注入 503 和连接中断，运行时保持单次调用重试与阶段续跑开启，
+并可按比例中途取消运行，使错误、取消和阶段续跑路径上的资源释放也被覆盖。
+
+用法:
+  python soak_test.py --iterations 1000 --concurrency 8
+  python soak_test.py --iterations 200 --concurrency 4 --use-selector --report soak.json
+  python soak_test.py --iterations 500 --failure-rate 0.2 --cancel-rate 0.05
+"""
+
+import argparse
+import asyncio
+import contextlib
+import gc
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+# 桩服务按代理角色返回的固定回复
+STUB_REPLIES = {
+    "coder": "```python\ndef add(a, b):\n    return a + b\n```",
+    "reviewer": "- 为参数添加类型注解\n- 补充文档字符串",
+    "integrator": (
+        "```python\ndef add(a: int, b: int) -> int:\n    \"\"\"返回两数之和。\"\"\"\n    return a + b\n```\nTERMINATE"
+    ),
+    "selector": "coder",
+}
+
+
+# ---- Stub OpenAI-compatible Server ----
+def _role_of(messages: List[Dict[str, Any]]) -> str:
+    system = next((m.get("content") or "" for m in messages if m.get("role") == "system"), "")
+    for role in ("coder", "reviewer", "integrator"):
+        if f"({role})" in system:
+            return role
+    return "selector"
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    latency = 0.0
+    failure_rate = 0.0
+
+    def do_POST(self) -> None:  # noqa: N802
+        length = int(self.headers.get("Content-Length") or 0)
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if not self.path.rstrip("/").endswith("/chat/completions") or request.get("stream"):
+            self.send_error(400, "stub server only supports non-streaming chat completions")
+            return
+        if self.latency:
+            time.sleep(self.latency)
+        if random.random() < self.failure_rate:
+            self._inject_failure()
+            return
+        content = STUB_REPLIES[_role_of(request.get("messages", []))]
+        prompt_tokens = sum(len(str(m.get("content") or "")) for m in request.get("messages", [])) // 4
+        completion_tokens = len(content) // 4
+        body = json.dumps({
+            "id": "chatcmpl-stub",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "stub"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _inject_failure(self) -> None:
+        """一半返回 503，一半不响应直接断开连接。"""
+        if random.random() < 0.5:
+            self.send_error(503, "injected failure")
+            return
+        self.close_connection = True
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def log_message(self, format: str, *args: object) -> None:
+        pass
+
+
+def serve_stub(port: int, latency: float, failure_rate: float = 0.0) -> None:
+    """运行桩服务（子进程入口）；实际监听端口写到标准输出的第一行。"""
+    handler = type("StubHandler", (_StubHandler,), {"latency": latency, "failure_rate": failure_rate})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    print(server.server_address[1], flush=True)
+    server.serve_forever()
+
+
+def start_stub_process(latency: float, failure_rate: float = 0.0) -> Tuple[subprocess.Popen, int]:
+    """在子进程中启动桩服务，使其连接和线程不计入被测进程的资源。"""
+    proc = subprocess.Popen(
+        [
+            sys.executable, os.path.abspath(__file__), "--serve-stub",
+            "--stub-latency", str(latency), "--failure-rate", str(failure_rate),
+        ],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    line = proc.stdout.readline() if proc.stdout else ""
+    if not line.strip().isdigit():
+        proc.kill()
+        raise RuntimeError("桩服务启动失败")
+    return proc, int(line)
+
+
+# ---- Resource Sampling ----
+def _rss_mb() -> Optional[float]:
+    try:
+        with open("/proc/self/status", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import resource
+        # 非 Linux 平台退而求其次使用峰值 RSS（macOS 单位为字节，Linux 为 KB）
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+    except ImportError:
+        return None
+
+
+def _open_fds() -> Tuple[Optional[int], Optional[int]]:
+    """返回 (打开的文件描述符数, 其中的 socket 数)，无法获取时为 None。"""
+    fd_dir = "/proc/self/fd" if os.path.isdir("/proc/self/fd") else "/dev/fd"
+    try:
+        fds = os.listdir(fd_dir)
+    except OSError:
+        return None, None
+    sockets = 0
+    for fd in fds:
+        try:
+            if os.readlink(os.path.join(fd_dir, fd)).startswith("socket:"):
+                sockets += 1
+        except OSError:
+            continue
+    return len(fds), sockets if fd_dir == "/proc/self/fd" else None
+
+
+def take_sample(iteration: int, started: float) -> Dict[str, Any]:
+    gc.collect()
+    fds, sockets = _open_fds()
+    current = asyncio.current_task()
+    return {
+        "iteration": iteration,
+        "elapsed": round(time.monotonic() - started, 2),
+        "rss_mb": round(_rss_mb() or 0.0, 1),
+        "fds": fds,
+        "sockets": sockets,
+        "tasks": len([t for t in asyncio.all_tasks() if t is not current and not t.done()]),
+    }
+
+
+# ---- Soak Runner ----
+async def soak(args: argparse.Namespace, base_url: str, output_dir: str) -> Dict[str, Any]:
+    # 延迟导入：桩服务子进程不需要加载 AutoGen
+    import metrics
+    from improved_three_agent_workflow import run_workflow
+    from model_clients import RetryPolicy, is_retryable
+
+    started = time.monotonic()
+    samples: List[Dict[str, Any]] = []
+    failures: List[str] = []
+    # 注入故障在重试耗尽后导致的失败、主动取消的运行都是预期结果，只计数不算失败
+    outcomes = {"completed": 0, "injected_errors": 0, "cancelled": 0}
+    retry_policy = RetryPolicy(
+        max_retries=args.max_retries,
+        stage_retries=args.stage_retries,
+        initial_backoff=args.retry_backoff,
+        max_backoff=args.retry_backoff * 8,
+    )
+    completed = 0
+    next_iteration = 0
+    real_stdout = sys.stdout
+
+    def report(sample: Dict[str, Any]) -> None:
+        samples.append(sample)
+        print(
+            f"[{sample['iteration']:>6}] {sample['elapsed']:>8}s  rss={sample['rss_mb']}MB  "
+            f"fds={sample['fds']}  sockets={sample['sockets']}  tasks={sample['tasks']}",
+            file=real_stdout,
+            flush=True,
+        )
+
+    async def run_batch(end: int) -> None:
+        async def worker() -> None:
+            nonlocal completed, next_iteration
+            while next_iteration < end:
+                iteration = next_iteration
+                next_iteration += 1
+                run = run_workflow(
+                    task=f"编写一个两数相加的函数（第 {iteration} 次）",
+                    api_key="stub",
+                    base_url=base_url,
+                    use_selector=args.use_selector,
+                    use_console_ui=False,
+                    timeout_seconds=args.timeout,
+                    retry_policy=retry_policy,
+                    output_dir=output_dir,
+                )
+                cancel = random.random() < args.cancel_rate
+                try:
+                    if cancel:
+                        # 超时后 wait_for 取消运行，走 run_workflow 的 CancelledError 分支
+                        await asyncio.wait_for(run, timeout=random.uniform(0, args.cancel_after))
+                    else:
+                        await run
+                    outcomes["completed"] += 1
+                except Exception as e:
+                    if cancel and isinstance(e, asyncio.TimeoutError):
+                        outcomes["cancelled"] += 1
+                    elif args.failure_rate and is_retryable(e):
+                        outcomes["injected_errors"] += 1
+                    else:
+                        failures.append(f"iteration {iteration}: {type(e).__name__}: {e}")
+                completed += 1
+                if end == args.iterations and completed % args.sample_every == 0 and completed < end:
+                    report(take_sample(completed, started))
+
+        await asyncio.gather(*(worker() for _ in range(max(1, args.concurrency))))
+        # 等待连接关闭等后台清理完成，再在空闲状态下采样
+        await asyncio.sleep(0.5)
+
+    # 工作流自身的输出量很大，浸泡期间丢弃，只保留采样报告
+    # 注入故障时的重试警告和错误堆栈写到标准错误，同样丢弃
+    with open(os.devnull, "w", encoding="utf-8") as devnull, contextlib.redirect_stdout(devnull), \
+            contextlib.redirect_stderr(devnull):
+        # 预热结束后的空闲采样作为基线，与全部运行结束后的空闲采样比较
+        await run_batch(args.warmup)
+        report(take_sample(completed, started))
+        await run_batch(args.iterations)
+    report(take_sample(completed, started))
+    outcomes["model_call_retries"] = int(metrics.MODEL_CALL_RETRIES.total())
+    outcomes["stage_resumes"] = int(metrics.STAGE_RESUMES.total())
+    return {"samples": samples, "failures": failures, "outcomes": outcomes}
+
+
+def check_growth(samples: List[Dict[str, Any]], args: argparse.Namespace) -> List[str]:
+    """比较预热后的基线采样与结束时的采样（两者都在空闲状态下获取），返回超出阈值的项。"""
+    if len(samples) < 2:
+        return []
+    baseline, last = samples[0], samples[-1]
+    limits = {
+        "rss_mb": args.max_rss_growth_mb,
+        "fds": args.max_fd_growth,
+        "sockets": args.max_socket_growth,
+        "tasks": args.max_task_growth,
+    }
+    problems: List[str] = []
+    for key, limit in limits.items():
+        if baseline[key] is None or last[key] is None:
+            continue
+        growth = last[key] - baseline[key]
+        if growth > limit:
+            problems.append(f"{key} 增长 {growth:g}（{baseline[key]} -> {last[key]}），超过阈值 {limit:g}")
+    return problems
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="run_workflow 负载 / 浸泡测试（本地桩服务，检测资源泄漏）")
+    parser.add_argument("--iterations", type=int, default=500, help="运行次数，默认500")
+    parser.add_argument("--concurrency", type=int, default=8, help="并发运行数，默认8")
+    parser.add_argument("--use-selector", action="store_true", help="使用 SelectorGroupChat 模式")
+    parser.add_argument("--timeout", type=int, default=60, help="单次运行超时时间（秒），默认60")
+    parser.add_argument("--warmup", type=int, default=20, help="预热运行次数，之后的首个采样作为基线，默认20")
+    parser.add_argument("--sample-every", type=int, default=50, help="每完成多少次运行采样一次，默认50")
+    parser.add_argument("--max-rss-growth-mb", type=float, default=64.0, help="允许的 RSS 增长（MB），默认64")
+    parser.add_argument("--max-fd-growth", type=int, default=16, help="允许的文件描述符增长，默认16")
+    parser.add_argument("--max-socket-growth", type=int, default=16, help="允许的 socket 增长，默认16")
+    parser.add_argument("--max-task-growth", type=int, default=0, help="允许的未完成 asyncio 任务增长，默认0")
+    parser.add_argument("--stub-latency", type=float, default=0.0, help="桩服务每次响应的模拟延迟（秒）")
+    parser.add_argument(
+        "--failure-rate", type=float, default=0.1, help="桩服务注入故障（503 或连接中断）的请求比例，默认0.1"
+    )
+    parser.add_argument("--cancel-rate", type=float, default=0.05, help="中途取消的运行比例，默认0.05")
+    parser.add_argument("--cancel-after", type=float, default=0.05, help="取消前的最长等待时间（秒），默认0.05")
+    parser.add_argument("--max-retries", type=int, default=1, help="单次模型调用最大重试次数，默认1（便于触发阶段续跑）")
+    parser.add_argument("--stage-retries", type=int, default=2, help="阶段续跑次数，默认2")
+    parser.add_argument("--retry-backoff", type=float, default=0.01, help="重试的初始退避时间（秒），默认0.01")
+    parser.add_argument("--report", default=None, help="把采样结果写入该 JSON 文件")
+    parser.add_argument("--keep-output", action="store_true", help="保留运行产生的记录文件目录")
+    parser.add_argument("--serve-stub", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    args.warmup = max(1, min(args.warmup, args.iterations))
+    args.sample_every = max(1, args.sample_every)
+    return args
+
+
+def main(argv: List[str]) -> int:
+    args = parse_args(argv)
+    if args.serve_stub:
+        serve_stub(0, args.stub_latency, args.failure_rate)
+        return 0
+
+    stub, port = start_stub_process(args.stub_latency, args.failure_rate)
+    output_dir = tempfile.mkdtemp(prefix="soak_task_md_")
+    try:
+        print(f"桩服务: http://127.0.0.1:{port}/v1，输出目录: {output_dir}")
+        result = asyncio.run(soak(args, f"http://127.0.0.1:{port}/v1", output_dir))
+    finally:
+        stub.terminate()
+        stub.wait(timeout=10)
+        if not args.keep_output:
+            shutil.rmtree(output_dir, ignore_errors=True)
+
+    problems = check_growth(result["samples"], args)
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump({**result, "problems": problems}, f, ensure_ascii=False, indent=2)
+
+    outcomes = result["outcomes"]
+    print(
+        f"完成 {outcomes['completed']} 次，取消 {outcomes['cancelled']} 次，注入故障导致失败 {outcomes['injected_errors']} 次；"
+        f"调用重试 {outcomes['model_call_retries']} 次，阶段续跑 {outcomes['stage_resumes']} 次"
+    )
+    if result["failures"]:
+        print(f"[ERROR] {len(result['failures'])} 次运行失败，首个错误: {result['failures'][0]}", file=sys.stderr)
+    for problem in problems:
+        print(f"[ERROR] 疑似资源泄漏: {problem}", file=sys.stderr)
+    if result["failures"] or problems:
+        return 1
+    print("浸泡测试通过：资源增长均在阈值内。")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))